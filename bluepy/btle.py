@@ -115,6 +115,8 @@ class UUID:
         return "-".join([s[0:8], s[8:12], s[12:16], s[16:20], s[20:32]])
 
     def __eq__(self, other):
+        if isinstance(other, UUID):
+            return self.binVal == other.binVal
         return self.binVal == UUID(other).binVal
 
     def __cmp__(self, other):
@@ -2,6 +2,22 @@ from bluepy.btle import UUID, Peripheral, DefaultDelegate, AssignedNumbers
 import struct
 import math
 
+# Pre-compiled struct formats for sensor data decoding
+_S_B   = struct.Struct("B")
+_S_H   = struct.Struct("<H")
+_S_bb  = struct.Struct("<bb")
+_S_hh  = struct.Struct("<hh")
+_S_HH  = struct.Struct("<HH")
+_S_hH  = struct.Struct("<hH")
+_S_bbb = struct.Struct("bbb")
+_S_hhh = struct.Struct("<hhh")
+_S_9h  = struct.Struct("<hhhhhhhhh")
+_S_BMP_CAL = struct.Struct("<HHHHhhhh")
+
+# Client Characteristic Configuration values
+_NOTIFY_ON  = _S_bb.pack(0x01, 0x00)
+_NOTIFY_OFF = _S_bb.pack(0x00, 0x00)
+
 def _TI_UUID(val):
     return UUID("%08X-0451-4000-b000-000000000000" % (0xF0000000+val))
 
@@ -12,8 +28,8 @@ SENSORTAG_2650 = "CC2650"
 
 class SensorBase:
     # Derived classes should set: svcUUID, ctrlUUID, dataUUID
-    sensorOn  = struct.pack("B", 0x01)
-    sensorOff = struct.pack("B", 0x00)
+    sensorOn  = _S_B.pack(0x01)
+    sensorOff = _S_B.pack(0x00)
 
     def __init__(self, periph):
         self.periph = periph
@@ -41,7 +57,13 @@ class SensorBase:
     # Derived class should implement _formatData()
 
 def calcPoly(coeffs, x):
-    return coeffs[0] + (coeffs[1]*x) + (coeffs[2]*x*x)
+    (c0, c1, c2) = coeffs
+    return c0 + x*(c1 + c2*x)
+
+def _polyFunc(coeffs):
+    # Returns calcPoly() specialised for fixed coefficients
+    (c0, c1, c2) = coeffs
+    return lambda x: c0 + x*(c1 + c2*x)
 
 class IRTemperatureSensor(SensorBase):
     svcUUID  = _TI_UUID(0xAA00)
@@ -50,6 +72,7 @@ class IRTemperatureSensor(SensorBase):
 
     zeroC = 273.15 # Kelvin
     tRef  = 298.15
+    tRefAmb = tRef - zeroC # tDie - tRef == tAmb - tRefAmb
     Apoly = [1.0,      1.75e-3, -1.678e-5]
     Bpoly = [-2.94e-5, -5.7e-7,  4.63e-9]
     Cpoly = [0.0,      1.0,      13.4]
@@ -57,21 +80,26 @@ class IRTemperatureSensor(SensorBase):
     def __init__(self, periph):
         SensorBase.__init__(self, periph)
         self.S0 = 6.4e-14
+        self._Apoly = _polyFunc(self.Apoly)
+        self._Bpoly = _polyFunc(self.Bpoly)
+        self._Cpoly = _polyFunc(self.Cpoly)
 
     def read(self):
         '''Returns (ambient_temp, target_temp) in degC'''
 
         # See http://processors.wiki.ti.com/index.php/SensorTag_User_Guide#IR_Temperature_Sensor
-        (rawVobj, rawTamb) = struct.unpack('<hh', self.data.read())
-        tAmb = rawTamb / 128.0
+        (rawVobj, rawTamb) = _S_hh.unpack(self.data.read())
+        tAmb = rawTamb * (1.0/128.0)
         Vobj = 1.5625e-7 * rawVobj
 
         tDie = tAmb + self.zeroC
-        S   = self.S0 * calcPoly(self.Apoly, tDie-self.tRef)
-        Vos = calcPoly(self.Bpoly, tDie-self.tRef)
-        fObj = calcPoly(self.Cpoly, Vobj-Vos)
+        dT   = tAmb - self.tRefAmb
+        S   = self.S0 * self._Apoly(dT)
+        Vos = self._Bpoly(dT)
+        fObj = self._Cpoly(Vobj-Vos)
 
-        tObj = math.pow( math.pow(tDie,4.0) + (fObj/S), 0.25 )
+        tDie2 = tDie*tDie
+        tObj = math.sqrt( math.sqrt( tDie2*tDie2 + (fObj/S) ) )
         return (tAmb, tObj - self.zeroC)
 
 
@@ -88,7 +116,7 @@ class IRTemperatureSensorTMP007(SensorBase):
     def read(self):
         '''Returns (ambient_temp, target_temp) in degC'''
         # http://processors.wiki.ti.com/index.php/CC2650_SensorTag_User's_Guide?keyMatch=CC2650&tisearch=Search-EN
-        (rawTobj, rawTamb) = struct.unpack('<hh', self.data.read())
+        (rawTobj, rawTamb) = _S_hh.unpack(self.data.read())
         tObj = (rawTobj >> 2) * self.SCALE_LSB;
         tAmb = (rawTamb >> 2) * self.SCALE_LSB;
         return (tAmb, tObj)
@@ -104,11 +132,13 @@ class AccelerometerSensor(SensorBase):
             self.scale = 64.0
         else:
             self.scale = 16.0
+        self._invScale = 1.0 / self.scale
 
     def read(self):
         '''Returns (x_accel, y_accel, z_accel) in units of g'''
-        x_y_z = struct.unpack('bbb', self.data.read())
-        return tuple([ (val/self.scale) for val in x_y_z ])
+        (x, y, z) = _S_bbb.unpack(self.data.read())
+        scale = self._invScale
+        return (x*scale, y*scale, z*scale)
 
 class MovementSensorMPU9250(SensorBase):
     svcUUID  = _TI_UUID(0xAA80)
@@ -118,6 +148,9 @@ class MovementSensorMPU9250(SensorBase):
     GYRO_XYZ =  7
     ACCEL_XYZ = 7 << 3
     MAG_XYZ = 1 << 6
+    GYRO_OFFSET  = 0    # byte offsets of each 3-axis group in the data record
+    ACCEL_OFFSET = 6
+    MAG_OFFSET   = 12
     ACCEL_RANGE_2G  = 0 << 8
     ACCEL_RANGE_4G  = 1 << 8
     ACCEL_RANGE_8G  = 2 << 8
@@ -130,15 +163,22 @@ class MovementSensorMPU9250(SensorBase):
     def enable(self, bits):
         SensorBase.enable(self)
         self.ctrlBits |= bits
-        self.ctrl.write( struct.pack("<H", self.ctrlBits) )
+        self.ctrl.write( _S_H.pack(self.ctrlBits) )
 
     def disable(self, bits):
         self.ctrlBits &= ~bits
-        self.ctrl.write( struct.pack("<H", self.ctrlBits) )
+        self.ctrl.write( _S_H.pack(self.ctrlBits) )
 
     def rawRead(self):
         dval = self.data.read()
-        return struct.unpack("<hhhhhhhhh", dval)
+        return _S_9h.unpack(dval)
+
+    def rawReadXYZ(self, offset):
+        # Decode just one 3-axis group of the 9-channel record
+        dval = self.data.read()
+        if len(dval) != _S_9h.size:
+            raise struct.error("MPU9250 data must be %d bytes, got %d" % (_S_9h.size, len(dval)))
+        return _S_hhh.unpack_from(dval, offset)
 
 class AccelerometerSensorMPU9250:
     def __init__(self, sensor_):
@@ -154,8 +194,9 @@ class AccelerometerSensorMPU9250:
 
     def read(self):
         '''Returns (x_accel, y_accel, z_accel) in units of g'''
-        rawVals = self.sensor.rawRead()[3:6]
-        return tuple([ v*self.scale for v in rawVals ])
+        (x, y, z) = self.sensor.rawReadXYZ(self.sensor.ACCEL_OFFSET)
+        scale = self.scale
+        return (x*scale, y*scale, z*scale)
 
 
 
@@ -164,14 +205,17 @@ class HumiditySensor(SensorBase):
     dataUUID = _TI_UUID(0xAA21)
     ctrlUUID = _TI_UUID(0xAA22)
 
+    T_SCALE  = 175.72 / 65536.0
+    RH_SCALE = 125.0 / 65536.0
+
     def __init__(self, periph):
         SensorBase.__init__(self, periph)
 
     def read(self):
         '''Returns (ambient_temp, rel_humidity)'''
-        (rawT, rawH) = struct.unpack('<HH', self.data.read())
-        temp = -46.85 + 175.72 * (rawT / 65536.0)
-        RH = -6.0 + 125.0 * ((rawH & 0xFFFC)/65536.0)
+        (rawT, rawH) = _S_HH.unpack(self.data.read())
+        temp = -46.85 + rawT * self.T_SCALE
+        RH = -6.0 + (rawH & 0xFFFC) * self.RH_SCALE
         return (temp, RH)
 
 class HumiditySensorHDC1000(SensorBase):
@@ -179,14 +223,17 @@ class HumiditySensorHDC1000(SensorBase):
     dataUUID = _TI_UUID(0xAA21)
     ctrlUUID = _TI_UUID(0xAA22)
 
+    T_SCALE  = 165.0 / 65536.0
+    RH_SCALE = 100.0 / 65536.0
+
     def __init__(self, periph):
         SensorBase.__init__(self, periph)
 
     def read(self):
         '''Returns (ambient_temp, rel_humidity)'''
-        (rawT, rawH) = struct.unpack('<HH', self.data.read())
-        temp = -40.0 + 165.0 * (rawT / 65536.0)
-        RH = 100.0 * (rawH/65536.0)
+        (rawT, rawH) = _S_HH.unpack(self.data.read())
+        temp = -40.0 + rawT * self.T_SCALE
+        RH = rawH * self.RH_SCALE
         return (temp, RH)
 
 class MagnetometerSensor(SensorBase):
@@ -194,13 +241,16 @@ class MagnetometerSensor(SensorBase):
     dataUUID = _TI_UUID(0xAA31)
     ctrlUUID = _TI_UUID(0xAA32)
 
+    SCALE = 1000.0 / 32768.0
+
     def __init__(self, periph):
         SensorBase.__init__(self, periph)
 
     def read(self):
         '''Returns (x, y, z) in uT units'''
-        x_y_z = struct.unpack('<hhh', self.data.read())
-        return tuple([ 1000.0 * (v/32768.0) for v in x_y_z ])
+        (x, y, z) = _S_hhh.unpack(self.data.read())
+        scale = self.SCALE
+        return (x*scale, y*scale, z*scale)
         # Revisit - some absolute calibration is needed
 
 class MagnetometerSensorMPU9250:
@@ -217,8 +267,9 @@ class MagnetometerSensorMPU9250:
 
     def read(self):
         '''Returns (x_mag, y_mag, z_mag) in units of uT'''
-        rawVals = self.sensor.rawRead()[6:9]
-        return tuple([ v*self.scale for v in rawVals ])
+        (x, y, z) = self.sensor.rawReadXYZ(self.sensor.MAG_OFFSET)
+        scale = self.scale
+        return (x*scale, y*scale, z*scale)
 
 class BarometerSensor(SensorBase):
     svcUUID  = _TI_UUID(0xAA40)
@@ -226,6 +277,8 @@ class BarometerSensor(SensorBase):
     ctrlUUID = _TI_UUID(0xAA42)
     calUUID  = _TI_UUID(0xAA43)
     sensorOn = None
+    calMode  = _S_B.pack(0x02)
+    measMode = _S_B.pack(0x01)
 
     def __init__(self, periph):
        SensorBase.__init__(self, periph)
@@ -235,21 +288,23 @@ class BarometerSensor(SensorBase):
         self.calChr = self.service.getCharacteristics(self.calUUID) [0]
 
         # Read calibration data
-        self.ctrl.write( struct.pack("B", 0x02), True )
-        (c1,c2,c3,c4,c5,c6,c7,c8) = struct.unpack("<HHHHhhhh", self.calChr.read())
+        self.ctrl.write( self.calMode, True )
+        (c1,c2,c3,c4,c5,c6,c7,c8) = _S_BMP_CAL.unpack(self.calChr.read())
         self.c1_s = c1/float(1 << 24)
         self.c2_s = c2/float(1 << 10)
         self.sensPoly = [ c3/1.0, c4/float(1 << 17), c5/float(1<<34) ]
         self.offsPoly = [ c6*float(1<<14), c7/8.0, c8/float(1<<19) ]
-        self.ctrl.write( struct.pack("B", 0x01), True )
+        self._sensPoly = _polyFunc(self.sensPoly)
+        self._offsPoly = _polyFunc(self.offsPoly)
+        self.ctrl.write( self.measMode, True )
 
 
     def read(self):
         '''Returns (ambient_temp, pressure_millibars)'''
-        (rawT, rawP) = struct.unpack('<hH', self.data.read())
+        (rawT, rawP) = _S_hH.unpack(self.data.read())
         temp = (self.c1_s * rawT) + self.c2_s
-        sens = calcPoly( self.sensPoly, float(rawT) )
-        offs = calcPoly( self.offsPoly, float(rawT) )
+        sens = self._sensPoly( float(rawT) )
+        offs = self._offsPoly( float(rawT) )
         pres = (sens * rawP + offs) / (100.0 * float(1<<14))
         return (temp,pres)
 
@@ -262,24 +317,31 @@ class BarometerSensorBMP280(SensorBase):
         SensorBase.__init__(self, periph)
 
     def read(self):
-        (tL,tM,tH,pL,pM,pH) = struct.unpack('<BBBBBB', self.data.read())
-        temp = (tH*65536 + tM*256 + tL) / 100.0
-        press = (pH*65536 + pM*256 + pL) / 100.0
+        # Two little-endian 24-bit values: temperature, then pressure
+        buf = self.data.read()
+        if len(buf) != 6:
+            raise struct.error("BMP280 data must be 6 bytes, got %d" % len(buf))
+        v = int.from_bytes(buf, 'little')
+        temp = (v & 0xFFFFFF) / 100.0
+        press = (v >> 24) / 100.0
         return (temp, press)
 
 class GyroscopeSensor(SensorBase):
     svcUUID  = _TI_UUID(0xAA50)
     dataUUID = _TI_UUID(0xAA51)
     ctrlUUID = _TI_UUID(0xAA52)
-    sensorOn = struct.pack("B",0x07)
+    sensorOn = _S_B.pack(0x07)
+
+    SCALE = 250.0 / 32768.0
 
     def __init__(self, periph):
        SensorBase.__init__(self, periph)
 
     def read(self):
         '''Returns (x,y,z) rate in deg/sec'''
-        x_y_z = struct.unpack('<hhh', self.data.read())
-        return tuple([ 250.0 * (v/32768.0) for v in x_y_z ])
+        (x, y, z) = _S_hhh.unpack(self.data.read())
+        scale = self.SCALE
+        return (x*scale, y*scale, z*scale)
 
 class GyroscopeSensorMPU9250:
     def __init__(self, sensor_):
@@ -294,8 +356,9 @@ class GyroscopeSensorMPU9250:
 
     def read(self):
         '''Returns (x_gyro, y_gyro, z_gyro) in units of degrees/sec'''
-        rawVals = self.sensor.rawRead()[0:3]
-        return tuple([ v*self.scale for v in rawVals ])
+        (x, y, z) = self.sensor.rawReadXYZ(self.sensor.GYRO_OFFSET)
+        scale = self.scale
+        return (x*scale, y*scale, z*scale)
 
 class KeypressSensor(SensorBase):
     svcUUID = UUID(0xFFE0)
@@ -305,29 +368,32 @@ class KeypressSensor(SensorBase):
 
     def __init__(self, periph):
         SensorBase.__init__(self, periph)
+        self.char_descr = None
  
     def enable(self):
         SensorBase.enable(self)
-        self.char_descr = self.service.getDescriptors(forUUID=0x2902)[0]
-        self.char_descr.write(struct.pack('<bb', 0x01, 0x00), True)
+        if self.char_descr is None:
+            self.char_descr = self.service.getDescriptors(forUUID=0x2902)[0]
+        self.char_descr.write(_NOTIFY_ON, True)
 
     def disable(self):
-        self.char_descr.write(struct.pack('<bb', 0x00, 0x00), True)
+        self.char_descr.write(_NOTIFY_OFF, True)
 
 class OpticalSensorOPT3001(SensorBase):
     svcUUID  = _TI_UUID(0xAA70)
     dataUUID = _TI_UUID(0xAA71)
     ctrlUUID = _TI_UUID(0xAA72)
 
+    # lux per count for each 4-bit exponent: 0.01 * 2**e
+    _expScale = tuple([ 0.01 * (1 << e) for e in range(16) ])
+
     def __init__(self, periph):
        SensorBase.__init__(self, periph)
 
     def read(self):
         '''Returns value in lux'''
-        raw = struct.unpack('<h', self.data.read()) [0]
-        m = raw & 0xFFF;
-        e = (raw & 0xF000) >> 12;
-        return 0.01 * (m << e)
+        raw = _S_H.unpack(self.data.read()) [0]
+        return (raw & 0xFFF) * self._expScale[raw >> 12]
 
 class BatterySensor(SensorBase):
     svcUUID  = UUID("0000180f-0000-1000-8000-00805f9b34fb")
@@ -340,7 +406,7 @@ class BatterySensor(SensorBase):
 
     def read(self):
         '''Returns the battery level in percent'''
-        val = ord(self.data.read())
+        (val,) = _S_B.unpack(self.data.read())
         return val
 
 class SensorTag(Peripheral):
@@ -348,7 +414,7 @@ class SensorTag(Peripheral):
         Peripheral.__init__(self,addr)
         if version==AUTODETECT:
             svcs = self.discoverServices()
-            if _TI_UUID(0xAA70) in svcs:
+            if OpticalSensorOPT3001.svcUUID in svcs:
                 version = SENSORTAG_2650
             else:
                 version = SENSORTAG_V1
@@ -398,11 +464,12 @@ class KeypressDelegate(DefaultDelegate):
     def handleNotification(self, hnd, data):
         # NB: only one source of notifications at present
         # so we can ignore 'hnd'.
-        val = struct.unpack("B", data)[0]
-        down = (val & ~self.lastVal) & self.ALL_BUTTONS
+        val = _S_B.unpack(data)[0]
+        lastVal = self.lastVal
+        down = (val & ~lastVal) & self.ALL_BUTTONS
         if down != 0:
             self.onButtonDown(down)
-        up = (~val & self.lastVal) & self.ALL_BUTTONS
+        up = (~val & lastVal) & self.ALL_BUTTONS
         if up != 0:
             self.onButtonUp(up)
         self.lastVal = val
@@ -468,24 +535,29 @@ def main():
     # Not waiting here after enabling a sensor, the first read value might be empty or incorrect.
     time.sleep(1.0)
 
+    # Work out which sensors to poll once, rather than on every iteration
+    polled = []
+    if arg.temperature or arg.all:
+        polled.append( ('Temp: ', tag.IRtemperature) )
+    if arg.humidity or arg.all:
+        polled.append( ("Humidity: ", tag.humidity) )
+    if arg.barometer or arg.all:
+        polled.append( ("Barometer: ", tag.barometer) )
+    if arg.accelerometer or arg.all:
+        polled.append( ("Accelerometer: ", tag.accelerometer) )
+    if arg.magnetometer or arg.all:
+        polled.append( ("Magnetometer: ", tag.magnetometer) )
+    if arg.gyroscope or arg.all:
+        polled.append( ("Gyroscope: ", tag.gyroscope) )
+    if (arg.light or arg.all) and tag.lightmeter is not None:
+        polled.append( ("Light: ", tag.lightmeter) )
+    if arg.battery or arg.all:
+        polled.append( ("Battery: ", tag.battery) )
+
     counter=1
     while True:
-       if arg.temperature or arg.all:
-           print('Temp: ', tag.IRtemperature.read())
-       if arg.humidity or arg.all:
-           print("Humidity: ", tag.humidity.read())
-       if arg.barometer or arg.all:
-           print("Barometer: ", tag.barometer.read())
-       if arg.accelerometer or arg.all:
-           print("Accelerometer: ", tag.accelerometer.read())
-       if arg.magnetometer or arg.all:
-           print("Magnetometer: ", tag.magnetometer.read())
-       if arg.gyroscope or arg.all:
-           print("Gyroscope: ", tag.gyroscope.read())
-       if (arg.light or arg.all) and tag.lightmeter is not None:
-           print("Light: ", tag.lightmeter.read())
-       if arg.battery or arg.all:
-           print("Battery: ", tag.battery.read())
+       for (label, sensor) in polled:
+           print(label, sensor.read())
        if counter >= arg.count and arg.count != 0:
            break
        counter += 1